@@ -0,0 +1,110 @@
+import numpy as np
+import threading
+import time
+
+# seconds a snapshot is used before the properties are fetched again. The device is recalibrated about once a day,
+# and a refresh only rebuilds the arrays when last_update_date has changed
+DEFAULT_TTL = 300
+
+# native two-qubit gates of ibm devices, in order of preference (ecr on eagle devices, cz on heron devices)
+TWO_QUBIT_GATES = ('ecr', 'cz', 'cx')
+
+# the native two-qubit gate in the target of backend
+def two_qubit_gate(backend) -> str:
+    operation_names = backend.target.operation_names
+    for name in TWO_QUBIT_GATES:
+        if name in operation_names:
+            return name
+    raise ValueError(f'no two-qubit gate among {TWO_QUBIT_GATES} in the target of {backend.name}')
+
+'''
+CalibrationSnapshot: calibration data of a backend loaded once into numpy arrays.
+backend.properties() is fetched once and kept until the snapshot is older than ttl. After the ttl, the properties are
+fetched again with refresh = True and the arrays are rebuilt only if last_update_date has changed.
+@ backend: the device
+@ ttl: seconds before the properties are fetched again, None keeps the first snapshot forever
+@ gate: name of the two-qubit gate whose errors are loaded, None uses the one in the target of backend (see two_qubit_gate)
+@ single_qubit_gate: name of the single-qubit gate whose errors stand for all single-qubit gates
+'''
+
+class CalibrationSnapshot:
+    def __init__(self, backend, ttl = DEFAULT_TTL, gate = None, single_qubit_gate = 'sx'):
+        self.backend = backend
+        self.ttl = ttl
+        self.gate = gate if gate != None else two_qubit_gate(backend)
+        self.single_qubit_gate = single_qubit_gate
+        self.lock = threading.Lock()
+        self.fetched = None # time.time() of the last fetch, None before the first one
+        self.last_update_date = None
+        self.readout_error = None # [qubit] -> readout error
+        self.gate_error = None # [q1, q2] -> error of the two-qubit gate on (q1, q2), nan where the device has no such gate
+        self.single_qubit_error = None # [qubit] -> error of the single-qubit gate
+
+    # fetch the properties if there is no snapshot or it has expired, return True if the arrays changed
+    def update(self) -> bool:
+        with self.lock:
+            if self.fetched != None and (self.ttl == None or time.time() - self.fetched < self.ttl):
+                return False
+            properties = self.backend.properties(refresh = self.fetched != None)
+            self.fetched = time.time()
+            if self.readout_error is not None and properties.last_update_date == self.last_update_date:
+                return False
+            self.load(properties)
+            return True
+
+    def load(self, properties):
+        num_qubits = self.backend.num_qubits
+        readout_error = np.full(num_qubits, np.nan)
+        single_qubit_error = np.full(num_qubits, np.nan)
+        gate_error = np.full((num_qubits, num_qubits), np.nan)
+        for q in range(num_qubits):
+            readout_error[q] = properties.readout_error(q)
+            single_qubit_error[q] = properties.gate_error(self.single_qubit_gate, q)
+        for q1, q2 in self.backend.coupling_map:
+            gate_error[q1, q2] = properties.gate_error(self.gate, (q1, q2))
+        self.readout_error = readout_error
+        self.gate_error = gate_error
+        self.single_qubit_error = single_qubit_error
+        self.last_update_date = properties.last_update_date
+
+    '''
+    region_errors: errors of many regions of the same shape at once
+    @ qubits: [region][qubit index] -> physical qubit
+    @ couplings: [region][link index] -> (q1, q2) physical qubits, links the device does not have give nan
+    return (link errors [region][link index], readout errors [region][qubit index])
+    '''
+    def region_errors(self, qubits, couplings) -> (np.ndarray, np.ndarray):
+        self.update()
+        qubits = np.asarray(qubits)
+        couplings = np.asarray(couplings)
+        return self.gate_error[couplings[..., 0], couplings[..., 1]], self.readout_error[qubits]
+
+    '''
+    region_scores: statistics of the errors of many regions of the same shape, see region_errors
+    return [region] -> (link_err_avg, link_err_max, link_err_min, link_err_var, readout_err_avg, readout_err_max, readout_err_min, readout_err_var)
+    '''
+    def region_scores(self, qubits, couplings) -> [tuple]:
+        link_err, readout_err = self.region_errors(qubits, couplings)
+        stats = []
+        for err in (link_err, readout_err):
+            stats += [np.nanmean(err, axis = 1), np.nanmax(err, axis = 1), np.nanmin(err, axis = 1), np.nanvar(err, axis = 1)]
+        return [tuple(float(s) for s in region) for region in np.stack(stats, axis = 1)]
+
+    '''
+    log_fidelity: log success probability of every resource of many regions of the same shape, in the layout of
+    vm_executable.gate_counts, so that log_fidelity(mappings) @ gate_counts(qc) is the log estimated success probability of qc on each region.
+    A two-qubit gate on (q1, q2) uses the gate of the device in either direction, pairs without a link are 0.
+    @ mappings: [region][virtual qubit] -> physical qubit
+    '''
+    def log_fidelity(self, mappings) -> np.ndarray:
+        # an error of 1 (a broken qubit or link) would give -inf, and -inf * 0 gates is nan
+        def log_success(err):
+            return np.log1p(-np.minimum(np.nan_to_num(err), 1 - 1e-9))
+
+        self.update()
+        mappings = np.asarray(mappings)
+        undirected = np.fmin(self.gate_error, self.gate_error.T) # fmin ignores nan
+        two_qubit = log_success(undirected[mappings[:, :, None], mappings[:, None, :]])
+        one_qubit = log_success(self.single_qubit_error[mappings])
+        measure = log_success(self.readout_error[mappings])
+        return np.concatenate([one_qubit, measure, two_qubit.reshape(len(mappings), -1)], axis = 1)
@@ -1,36 +1,109 @@
 from qiskit.providers import JobV1
+from qiskit.primitives import BitArray
 from collections import defaultdict
+import numpy as np
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
 class CombinerJob(JobV1):
-    def __init__(self, job: JobV1, circuit_map: [list], clbits: [list], backend, **fields):
+    def __init__(self, job: JobV1, circuit_map: [list], clbits: [list], backend, registers: [[str]] = None, executables: list = None, selection: list = None, pub_sizes: [int] = None,
+                 pub_selections: [list] = None, serialized: bytes = None, attempt = 1, first_submitted = None, **fields):
         self.job = job
         self.circuit_map = circuit_map
         self.clbits = clbits
+        # the job may run several combined circuits (pubs), pub_sizes[p] programs in pub p.
+        # circuit_map, selection and the per-program lists are flattened over the pubs, in the order of the programs
+        self.pub_sizes = pub_sizes if pub_sizes != None else [len(clbits)]
+        self.pub_index = [p for p, size in enumerate(self.pub_sizes) for _ in range(size)] # pub of each program
+        # names of the classical registers of each program in the combined circuit (same order as clbits).
+        # If known, results are read per register instead of splitting the joined bitstrings.
+        self.registers = registers
         self._backend = backend
+        # the primitive result and what is derived from it are computed once, guarded by lock
+        self.lock = threading.RLock()
+        self._primitive_result = None
+        self._counts = None
+        self._bitarrays = None
+        self._futures = None
+        # the schedule this job was built from, and the schedule of each pub (pub_selections[p] is the selection of pub p,
+        # its indexes refer to the queue after the programs of pubs 0..p-1 were removed)
+        self.selection = selection
+        self.pub_selections = pub_selections if pub_selections != None else [selection]
+        # qpy copy of the submitted circuits for resubmission, the number of this submission and the time of the first one
+        self.serialized = serialized
+        self.attempt = attempt
+        self.first_submitted = first_submitted if first_submitted != None else time.time()
+        # one handle per program, in the order of clbits. executables[i] is the vm_executable of program i
+        self.programs = [ProgramJob(self, i, executables[i] if executables != None else None) for i in range(len(clbits))]
         super().__init__(backend, '', **fields)
 
+    # result of the underlying sampler job, fetched once. A failed job raises every time and is not cached.
+    def primitive_result(self):
+        with self.lock:
+            if self._primitive_result == None:
+                self._primitive_result = self.job.result()
+            return self._primitive_result
+
+    # counts of each program, computed once and shared by all callers (do not modify them)
     def result(self) -> [dict]:
+        with self.lock:
+            if self._counts == None:
+                self._counts = self.demux()
+            return self._counts
+
+    def demux(self) -> [dict]:
+        if self.registers != None:
+            return [bitarray_counts(bits) for bits in self.bitarrays()]
 
         # Why sometimes there are spaces in the result?
-        result = self.job.result()
-        counts = result[0].join_data().get_counts() if len(result[0].data) > 1 else list(result[0].data.values())[0].get_counts()
-        clbits = self.clbits
-
-        circ_cnt = len(clbits)
-        counts_individual = []
-        for i in range(circ_cnt):
-            counts_individual.append(defaultdict(int))
-
-        for k, v in counts.items():
-            offset = 1
-            # remove spaces
-            k = k.replace(' ', '')
-            for i in range(circ_cnt-1, -1, -1): # correction: reverse order
-            #for i in range(circ_cnt):
-                ki = k[offset:offset+clbits[i]]
-                counts_individual[i][ki] += v
-                offset += clbits[i]
-                
-        return counts_individual
+        result = self.primitive_result()
+        ret = []
+        start = 0
+        for p, size in enumerate(self.pub_sizes):
+            counts = result[p].join_data().get_counts() if len(result[p].data) > 1 else list(result[p].data.values())[0].get_counts()
+            ret += demux_counts(counts, self.clbits[start:start+size])
+            start += size
+        return ret
+
+    # outcomes of each program as a BitArray (shots x clbits of the program), taken from the sampler's
+    # per-register arrays without building the joined counts of the combined circuit
+    def bitarrays(self) -> [BitArray]:
+        assert self.registers != None, 'register names are unknown, use result()'
+        with self.lock:
+            if self._bitarrays == None:
+                result = self.primitive_result()
+                ret = []
+                for p, names in zip(self.pub_index, self.registers):
+                    data = result[p].data
+                    num_shots = next(iter(data.values())).num_shots
+                    if len(names) == 0:
+                        ret.append(BitArray(np.zeros((num_shots, 0), dtype = np.uint8), 0))
+                    else:
+                        # the first register holds the least significant bits, same as join_data
+                        ret.append(BitArray.concatenate_bits([data[name] for name in names]))
+                self._bitarrays = ret
+            return self._bitarrays
+
+    # one Future per program, resolved with the counts of the program (or the exception of the job) when the job finishes
+    def futures(self) -> [Future]:
+        with self.lock:
+            if self._futures == None:
+                self._futures = [Future() for _ in self.clbits]
+                get_result_executor().submit(self.resolve_futures)
+            return self._futures
+
+    def resolve_futures(self):
+        try:
+            counts = self.result()
+        except Exception as e:
+            for future in self._futures:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+        for future, c in zip(self._futures, counts):
+            if future.set_running_or_notify_cancel(): # skip futures cancelled by their owner
+                future.set_result(c)
 
     def job_id(self):
         return self.job.job_id()
@@ -42,4 +115,105 @@ class CombinerJob(JobV1):
         self.job.submit()
 
     def time_taken(self):
-        return self.job.result().time_taken
\ No newline at end of file
+        return self.primitive_result().time_taken
+
+    # execution spans reported by the runtime, None if the result has no timing metadata
+    def execution_spans(self):
+        metadata = self.primitive_result().metadata
+        return metadata.get('execution', {}).get('execution_spans')
+
+    # time in seconds the device spent on this job, None if the result has no execution spans (e.g. local simulators)
+    def duration(self) -> float:
+        spans = self.execution_spans()
+        return spans.duration if spans != None else None
+
+'''
+ProgramJob: handle of one program inside a combined job, so each program's owner can wait for its own results.
+@ combiner: the CombinerJob running the program
+@ index: position of the program in the combined job (same order as CombinerJob.clbits)
+@ executable: the vm_executable submitted for this program
+'''
+
+class ProgramJob:
+    def __init__(self, combiner: CombinerJob, index: int, executable = None):
+        self.combiner = combiner
+        self.index = index
+        self.executable = executable
+
+    def result(self) -> dict:
+        return self.combiner.result()[self.index]
+
+    def bitarray(self) -> BitArray:
+        return self.combiner.bitarrays()[self.index]
+
+    # resolved with the counts of this program
+    def future(self) -> Future:
+        return self.combiner.futures()[self.index]
+
+    def job_id(self):
+        return f'{self.combiner.job_id()}/{self.index}'
+
+    def status(self):
+        return self.combiner.status()
+
+    # see CombinerJob.duration
+    def duration(self) -> float:
+        return self.combiner.duration()
+
+# threads waiting for combined jobs to finish and resolving their futures
+result_executor = None
+result_executor_lock = threading.Lock()
+
+def get_result_executor() -> ThreadPoolExecutor:
+    global result_executor
+    with result_executor_lock:
+        if result_executor == None:
+            result_executor = ThreadPoolExecutor(thread_name_prefix = 'CombinerJob')
+        return result_executor
+
+# counts of a BitArray as a defaultdict, in the format of result()
+def bitarray_counts(bits: BitArray) -> dict:
+    if bits.num_bits == 0: # get_counts does not handle empty bitstrings
+        return defaultdict(int, {'': bits.num_shots})
+    return defaultdict(int, bits.get_counts())
+
+'''
+demux_counts: split the counts of a combined circuit into the counts of each program.
+Bitstrings are turned into a 0/1 matrix once, each program's bits are packed into integers with shifts,
+and equal outcomes are summed with np.unique + np.bincount instead of slicing every key in python.
+@ counts: counts of the combined circuit, spaces between registers are ignored
+@ clbits: number of clbits of each program, program 0 is the rightmost in the bitstring
+@ offset: number of leading bits to skip (the dummy register added by HypervisorBackend)
+'''
+
+def demux_counts(counts: dict, clbits: [int], offset = 1) -> [dict]:
+    counts_individual = [defaultdict(int) for _ in clbits]
+    if len(counts) == 0:
+        return counts_individual
+
+    # remove spaces
+    keys = [k.replace(' ', '') for k in counts]
+    shots = np.fromiter(counts.values(), dtype = np.int64, count = len(keys))
+    bits = np.frombuffer(''.join(keys).encode(), dtype = np.uint8).reshape(len(keys), len(keys[0])) - ord('0')
+
+    for i in range(len(clbits)-1, -1, -1): # correction: reverse order
+        width = clbits[i]
+        segment = bits[:, offset:offset+width]
+        offset += width
+        if width == 0:
+            counts_individual[i][''] += int(shots.sum())
+            continue
+
+        if width < 64:
+            packed = segment.astype(np.int64) @ (np.int64(1) << np.arange(width-1, -1, -1, dtype = np.int64))
+            outcomes, inverse = np.unique(packed, return_inverse = True)
+            keys_individual = [format(int(outcome), f'0{width}b') for outcome in outcomes]
+        else: # too wide to pack into an integer, compare the rows as raw bytes
+            rows = np.ascontiguousarray(segment + ord('0')).view(np.dtype((np.void, width))).reshape(-1)
+            outcomes, inverse = np.unique(rows, return_inverse = True)
+            keys_individual = [outcome.tobytes().decode() for outcome in outcomes]
+        totals = np.bincount(inverse.reshape(-1), weights = shots, minlength = len(outcomes))
+        for k, total in zip(keys_individual, totals):
+            counts_individual[i][k] += int(total)
+
+    return counts_individual
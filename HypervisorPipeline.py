@@ -0,0 +1,75 @@
+from HypervisorBackend import HypervisorBackend
+from CombinerJob import CombinerJob, get_result_executor
+import queue
+
+'''
+HypervisorPipeline: keep up to max_in_flight combined jobs on the device and prepare (schedule + combine) the next batch
+while they run, so the device queue does not drain while the host is busy. Finished jobs are returned in the order they
+finish, not the order they were submitted. Failed jobs are resubmitted according to the retry policy of the hypervisor.
+@ hypervisor: a HypervisorBackend
+@ max_in_flight: maximum number of submitted jobs that have not finished
+@ pubs_per_job: number of successive batches submitted together as the pubs of one job (see HypervisorBackend.run_batches)
+@ time_sched, intra_vm_sched, noise_aware, packing, packing_budget, fidelity_aware, guard_band: passed to HypervisorBackend.schedule
+@ requeue_failed: put the programs of a job that failed every attempt back to the front of the executable queue,
+up to max_requeues times per program (see HypervisorBackend.requeue). The programs dropped after that are listed in dropped
+'''
+
+class HypervisorPipeline:
+    def __init__(self, hypervisor: HypervisorBackend, max_in_flight = 3, pubs_per_job = 1, time_sched = False, intra_vm_sched = False, noise_aware = False, packing = False, packing_budget = 1.0, fidelity_aware = False, guard_band = False, requeue_failed = False):
+        self.hypervisor = hypervisor
+        self.max_in_flight = max_in_flight
+        self.pubs_per_job = pubs_per_job
+        self.schedule_args = (time_sched, intra_vm_sched, noise_aware, packing, packing_budget, fidelity_aware, guard_band)
+        self.requeue_failed = requeue_failed
+        self.in_flight = [] # submitted jobs that have not been returned by run
+        self.finished = queue.Queue() # (submitted job, last job after retries)
+        self.dropped = [] # programs of failed jobs that were not requeued again
+
+    '''
+    run: generator of finished CombinerJobs (the result is already fetched; a failed job raises again in result()).
+    After a resubmission, the returned job is the last attempt, not the job passed to on_submit.
+    Executables are removed from the list when their batch is prepared. The caller may append new executables
+    to the list between two finished jobs, they are scheduled in the following batches.
+    @ executables: the executable queue
+    @ on_submit: called with each job right after it is submitted, before the next batch is prepared
+    '''
+    def run(self, executables: list, on_submit = None):
+        batches = None
+        while len(executables) or batches != None or len(self.in_flight):
+            # hand back what has finished so far without waiting
+            while not self.finished.empty():
+                yield self.collect(*self.finished.get(), executables)
+
+            if batches == None and len(executables):
+                batches = self.hypervisor.prepare_batches(executables, self.pubs_per_job, *self.schedule_args)
+                if len(batches) == 0:
+                    raise ValueError('no executable in the queue fits the backend')
+
+            if batches != None and len(self.in_flight) < self.max_in_flight:
+                job = self.hypervisor.submit_batches(batches)
+                batches = None
+                self.in_flight.append(job)
+                get_result_executor().submit(self.wait, job)
+                if on_submit != None:
+                    on_submit(job)
+                continue
+
+            # nothing can be submitted or prepared, wait for a job to finish
+            if len(self.in_flight):
+                yield self.collect(*self.finished.get(), executables)
+
+    def wait(self, job: CombinerJob):
+        try:
+            last_job = self.hypervisor.wait(job)
+        except Exception: # the caller sees the error when reading the result
+            last_job = job
+        self.finished.put((job, last_job))
+
+    def collect(self, job: CombinerJob, last_job: CombinerJob, executables: list) -> CombinerJob:
+        self.in_flight.remove(job)
+        if self.requeue_failed:
+            try:
+                last_job.primitive_result()
+            except Exception:
+                self.dropped += self.hypervisor.requeue(last_job, executables)
+        return last_job
@@ -0,0 +1,158 @@
+from vm_executable import estimate_duration
+from qiskit.primitives import BitArray, DataBin, PrimitiveResult, SamplerPubResult, BackendSamplerV2
+from qiskit.providers import JobStatus
+from qiskit_ibm_runtime.options import SamplerOptions
+from qiskit_ibm_runtime.execution_span import ExecutionSpans, SliceSpan
+from qiskit_ibm_runtime.fake_provider import FakeBrisbane
+from qiskit_ibm_runtime import RuntimeJobFailureError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import threading
+import time
+import uuid
+
+'''
+SimulatedDevice: an offline stand-in for the runtime Sampler, pass it to HypervisorBackend(..., sampler = SimulatedDevice(backend)).
+Jobs run one after another on a simulated device clock. The execution time of a pub is
+    pub_overhead + shots * (circuit duration + rep_delay + shot_overhead)
+where the circuit duration is the critical path with the instruction durations of the backend target.
+Results carry execution_spans with these times, like results of the real device.
+@ backend: a fake heavy-hex backend (default FakeBrisbane), provides the target and the noise model
+@ counts: 'random' draws uniformly random bits (fast, for throughput and scheduling tests),
+'ideal' samples with a noiseless Aer simulator, 'noisy' with the noise model of the backend
+(matrix product state, slow for circuits with time-shared qubits because the resets are simulated shot by shot)
+@ rep_delay: default delay between shots in seconds, overridden by options.execution.rep_delay
+@ shot_overhead: time per shot not covered by the circuit and rep_delay (reset, readout, classical processing)
+@ pub_overhead: time per pub (loading the circuit, setting up the electronics)
+@ time_scale: result() blocks until time_scale * (simulated waiting + execution time) has passed since submission, 0 returns at once
+@ failure_rate: probability that a job fails (its result raises RuntimeJobFailureError), to test failure handling
+@ seed: seed of the random counts, the failures and the Aer simulator
+'''
+
+class SimulatedDevice:
+    def __init__(self, backend = None, counts = 'random', rep_delay = 250e-6, shot_overhead = 20e-6, pub_overhead = 0.5, time_scale = 0.0, failure_rate = 0.0, seed = None):
+        assert counts in ('random', 'ideal', 'noisy'), 'counts should be random, ideal or noisy'
+        self.backend = backend if backend != None else FakeBrisbane()
+        self.counts = counts
+        self.rep_delay = rep_delay
+        self.shot_overhead = shot_overhead
+        self.pub_overhead = pub_overhead
+        self.time_scale = time_scale
+        self.failure_rate = failure_rate
+        self.rng = np.random.default_rng(seed)
+        self.seed = seed
+        self.options = SamplerOptions(default_shots = 4096)
+        self.simulator = None
+        # the device runs one job at a time
+        self.executor = ThreadPoolExecutor(max_workers = 1)
+        self.lock = threading.Lock()
+        self.device_free_at = datetime.now(timezone.utc) # end of the last job on the simulated clock
+
+    # same interface as SamplerV2.run
+    def run(self, pubs, shots = None) -> 'SimulatedJob':
+        if shots == None:
+            shots = self.options.default_shots
+        rep_delay = self.options.execution.rep_delay
+        if not isinstance(rep_delay, (int, float)): # unset
+            rep_delay = self.rep_delay
+        circuits = [pub if not isinstance(pub, tuple) else pub[0] for pub in pubs]
+        pub_times = [self.pub_time(circ, shots, rep_delay) for circ in circuits]
+
+        with self.lock:
+            submitted = datetime.now(timezone.utc)
+            start = max(submitted, self.device_free_at)
+            spans = []
+            for i, pub_time in enumerate(pub_times):
+                stop = start + timedelta(seconds = pub_time)
+                spans.append(SliceSpan(start, stop, {i: ((shots,), slice(0, shots))}))
+                start = stop
+            self.device_free_at = start
+
+        # seconds from submission to the end of the job on the simulated clock, including waiting for earlier jobs
+        job = SimulatedJob(self, circuits, shots, ExecutionSpans(spans), (start - submitted).total_seconds())
+        job.fails = self.rng.random() < self.failure_rate
+        job.future = self.executor.submit(job.execute)
+        return job
+
+    def pub_time(self, circ, shots, rep_delay) -> float:
+        duration = estimate_duration(circ, self.backend.target)
+        return self.pub_overhead + shots*(duration + rep_delay + self.shot_overhead)
+
+    def sample(self, circuits, shots) -> [SamplerPubResult]:
+        if self.counts == 'random':
+            ret = []
+            for circ in circuits:
+                data = {}
+                for creg in circ.cregs:
+                    bits = self.rng.integers(0, 2, size = (shots, creg.size), dtype = bool)
+                    data[creg.name] = BitArray.from_bool_array(bits) if creg.size else BitArray(bits.astype(np.uint8), 0)
+                ret.append(SamplerPubResult(DataBin(**data, shape = ()), metadata = {'shots': shots}))
+            return ret
+
+        if self.simulator == None:
+            from qiskit_aer import AerSimulator
+            # the combined circuit spans the whole device, the programs are not entangled with each other
+            if self.counts == 'noisy':
+                simulator = AerSimulator.from_backend(self.backend, method = 'matrix_product_state', seed_simulator = self.seed)
+            else:
+                simulator = AerSimulator(method = 'matrix_product_state', seed_simulator = self.seed)
+            self.simulator = BackendSamplerV2(backend = simulator)
+        return list(self.simulator.run([without_dummy_condition(circ) for circ in circuits], shots = shots).result())
+
+# HypervisorBackend adds an if_test on the never measured 'dummy' register to run the circuit as a dynamic circuit.
+# It never fires, and Aer cannot load it together with the resets of time-shared qubits, so it is removed before simulation
+def without_dummy_condition(circ):
+    ret = circ.copy_empty_like()
+    for inst in circ.data:
+        condition = getattr(inst.operation, 'condition', None)
+        if condition != None and getattr(condition[0], 'name', None) == 'dummy':
+            continue
+        ret._append(inst)
+    return ret
+
+'''
+SimulatedJob: job returned by SimulatedDevice.run, behaves like a RuntimeJobV2 for HypervisorBackend and CombinerJob
+'''
+
+class SimulatedJob:
+    def __init__(self, device: SimulatedDevice, circuits, shots, spans: ExecutionSpans, finish_offset: float):
+        self.device = device
+        self.circuits = circuits
+        self.shots = shots
+        self.spans = spans
+        self.finish_offset = finish_offset
+        self.created = time.time()
+        self.id = str(uuid.uuid4())
+        self.future = None
+        self.fails = False
+
+    def execute(self) -> PrimitiveResult:
+        if self.fails:
+            raise RuntimeJobFailureError(f'Simulated failure of job {self.id}')
+        pub_results = self.device.sample(self.circuits, self.shots)
+        return PrimitiveResult(pub_results, metadata = {'execution': {'execution_spans': self.spans}, 'version': 2})
+
+    def result(self) -> PrimitiveResult:
+        result = self.future.result()
+        remaining = self.created + self.device.time_scale*self.finish_offset - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        return result
+
+    def job_id(self) -> str:
+        return self.id
+
+    def status(self) -> JobStatus:
+        if self.future.running():
+            return JobStatus.RUNNING
+        if not self.future.done():
+            return JobStatus.QUEUED
+        if self.future.exception() != None:
+            return JobStatus.ERROR
+        if time.time() < self.created + self.device.time_scale*self.finish_offset:
+            return JobStatus.RUNNING
+        return JobStatus.DONE
+
+    def done(self) -> bool:
+        return self.status() in (JobStatus.DONE, JobStatus.ERROR)
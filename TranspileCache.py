@@ -0,0 +1,67 @@
+from qiskit import transpile, qpy
+import qiskit
+import hashlib
+import io
+import os
+
+'''
+TranspileCache: content-addressed on-disk cache of compiled circuits.
+The key is made of the source circuit (its qpy serialization), the target coupling map, basis gates and number of qubits,
+the transpiler settings and the qiskit version. Compiled circuits are stored as <key>.qpy under path,
+so restarting a benchmark or running the same workload again skips compilation.
+@ path: cache directory, created if it does not exist
+@ transpile_args: extra arguments passed to qiskit.transpile, they are part of the key
+'''
+
+class TranspileCache:
+    def __init__(self, path = 'transpile_cache', **transpile_args):
+        self.path = path
+        self.transpile_args = transpile_args
+        self.memory = {} # key -> compiled circuit, avoid reading the same file twice in one run
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok = True)
+
+    def key(self, qc, backend) -> str:
+        h = hashlib.sha256()
+        buf = io.BytesIO()
+        qpy.dump(qc, buf)
+        h.update(buf.getvalue())
+        h.update(str(backend.num_qubits).encode())
+        coupling_map = backend.coupling_map
+        edges = sorted(coupling_map.get_edges()) if coupling_map is not None else []
+        h.update(str(edges).encode())
+        h.update(str(sorted(backend.operation_names)).encode())
+        h.update(str(sorted(self.transpile_args.items())).encode())
+        h.update(qiskit.__version__.encode())
+        return h.hexdigest()
+
+    # same as qiskit.transpile(qc, backend, **transpile_args) but reads the result from the cache if possible
+    def transpile(self, qc, backend):
+        key = self.key(qc, backend)
+        if key in self.memory:
+            self.hits += 1
+            return self.memory[key]
+
+        filename = os.path.join(self.path, key + '.qpy')
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                compiled = qpy.load(f)[0]
+            self.hits += 1
+        else:
+            compiled = transpile(qc, backend, **self.transpile_args)
+            # write to a temporary file first so other processes never read a partial file
+            tmp_filename = filename + f'.{os.getpid()}.tmp'
+            with open(tmp_filename, 'wb') as f:
+                qpy.dump(compiled, f)
+            os.replace(tmp_filename, filename)
+            self.misses += 1
+
+        self.memory[key] = compiled
+        return compiled
+
+    # the in-memory copies are not pickled (e.g. when sent to a worker process), they are read back from path when needed
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memory'] = {}
+        return state
@@ -11,7 +11,10 @@
 # 8. calibration data output path
 
 from HypervisorBackend import *
+from qvm_partition import load_device_profile
 from vm_executable import *
+from TranspileCache import TranspileCache
+from HypervisorPipeline import HypervisorPipeline
 from qiskit import QuantumCircuit, transpile
 from qiskit_ibm_runtime import QiskitRuntimeService, RuntimeJobFailureError
 from qiskit_ibm_runtime import SamplerV2 as Sampler
@@ -81,27 +84,17 @@ backend = real_backend
 
 # create virtual backend
 basis_gates = real_backend.basis_gates #['ecr', 'id', 'rz', 'sx', 'x']
-hc = [(2, -2), (-2, 0), (6, -1), (-1, 4)]
-vc = [(4, -3), (-3, -2), (-2, -1), (-1, 0)]
-shared_up = {-3: -1}
-shared_down = {-1: -2}
-vm_coupling_map = [[1, 0], [0, 1], [1, 2], [2, 1], [1, 3], [3, 1], [3, 5], [5, 3], [4, 5], [5, 4], [5, 6], [6, 5]]
-allowed_dimensions = [(1, 1), (1, 2), (2, 1), (1, 3), (3, 1), (2, 2), (2, 3), (3, 2), (3, 3)]
+# qvm partition of the device, computed from its coupling map and cached in device_profiles/
+profile = load_device_profile(real_backend)
+hc, vc, shared_up, shared_down = profile.hc, profile.vc, profile.shared_up, profile.shared_down
+vm_coupling_map = profile.vm_coupling_map
+allowed_dimensions = profile.allowed_dimensions
 
 # vm qubit mappings
-vms = [[[3, 4, 5, 15, 21, 22, 23], [7, 8, 9, 16, 25, 26, 27], [11, 12, 13, 17, 29, 30, 31]], 
-       [[40, 41, 42, 53, 59, 60, 61], [44, 45, 46, 54, 63, 64, 65], [48, 49, 50, 55, 67, 68, 69]], 
-       [[78, 79, 80, 91, 97, 98, 99], [82, 83, 84, 92, 101, 102, 103], [86, 87, 88, 93, 105, 106, 107]]]
+vms, hc_backend, vc_backend = profile.vms, profile.hc_backend, profile.vc_backend
 
-hc_backend = [[[6, 24], [10, 28]], 
-              [[43, 62], [47, 66]],
-              [[81, 100], [85, 104]]]
-
-vc_backend = [[[20, 33, 39], [24, 34, 43], [28, 35, 47]],
-              [[58, 71, 77], [62, 72, 81], [66, 73, 85]]]
-
-# create hypervisor backend
-hypervisor = HypervisorBackend(backend, vms, hc_backend, vc_backend)
+# create hypervisor backend, a failed job is resubmitted from its serialized copy with a longer rep_delay
+hypervisor = HypervisorBackend(backend, vms, hc_backend, vc_backend, retry_policy = RetryPolicy(max_attempts = 3, backoff = 10, retry_rep_delay = 0.0005), calibration_ttl = 300)
 
 # get QASMbenchmark object
 path = "../QASMBench"
@@ -121,21 +114,21 @@ circ_list_medium = list(bm_medium.get(i) for i in circ_name_list_medium)
 circ_name_list = circ_name_list_small + circ_name_list_medium
 circ_list = circ_list_small + circ_list_medium
 
-exec_list = []
-for i, circ in enumerate(circ_list):
-    evm = elastic_vm(circ.num_qubits, basis_gates, hc, vc, shared_up, shared_down, vm_coupling_map, allowed_dimensions)
-    #print('transpiling', circ_name_list[i])
-    exe = vm_executable(circ, evm, True)
-    exec_list.append(exe)
+# compiled circuits are cached on disk, so restarting the benchmark skips compilation
+transpile_cache = TranspileCache('transpile_cache')
+# compile all circuits in a process pool
+exec_list, compile_time = build_executables(circ_list, basis_gates, hc, vc, shared_up, shared_down, vm_coupling_map, allowed_dimensions, True, cache = transpile_cache)
+for i in range(len(circ_list)):
+    print('compiled', circ_name_list[i], 'in', compile_time[i], 's')
 
 exec_queue = list(exec_list[i] for i in job_queue)
-exec_queue_names = list(circ_name_list[i] for i in job_queue)
+# circuit index of each executable, to name the programs of a job and put the programs of a failed job back to the queue
+exec_index = {id(exec_list[i]): i for i in range(len(exec_list))}
 
 def count_to_prob(counts: dict, shots: int):
     for k in counts:
         counts[k] /= shots
 
-real_job_queue = []
 tot_par = 0
 tot_depth = 0
 job_cnt = 0
@@ -144,51 +137,43 @@ log_file = open(output_path + 'workload' + workload_id + '.txt', 'a')
 sys.stdout = Tee(sys.stdout, log_file)
 
 
-while len(exec_queue):
-    selection = hypervisor.schedule(exec_queue, time_sched = False, intra_vm_sched = True, noise_aware = False) 
+# schedule and combine the next batch while up to 3 jobs are running
+pipeline = HypervisorPipeline(hypervisor, max_in_flight = 3, time_sched = False, intra_vm_sched = True, noise_aware = False)
+
+def log_submit(job):
+    selection = job.selection
     print('selection:', selection)
-    # for j in selection:
-    #     print(exec_queue_names[j[0]], end=' ')
-    # print()
+    # name the programs from the job itself: the queue may have changed (e.g. a failed job requeued)
+    # between preparing this batch and submitting it, so the indexes in the selection are not valid any more
+    programs = [exec_index[id(program.executable)] for program in job.programs]
     names = []
+    offset = 0
     for i in selection:
-       names.append(tuple(exec_queue_names[i[0][j]] for j in range(len(i[0]))))
+        names.append(tuple(circ_name_list[k] for k in programs[offset:offset+len(i[0])]))
+        offset += len(i[0])
     print(names)
 
-    if len(real_job_queue) == 3:
-        try:
-            res = real_job_queue[0].result() # use result to block
-        except RuntimeJobFailureError:
-            print('failed job:', real_job_queue[0].job_id())
-        real_job_queue.pop(0)
-        # write calibration data when a job finishes
-        cal_file.write(str(score_all(hypervisor, vm_coupling_map)) + '\n')
-
-    #for real run
-    job = hypervisor.run(exec_queue, selection=selection, dynamic=True)
-    real_job_queue.append(job)
-
     print(job.job_id(), 'combined', sum(len(s[0]) for s in selection))
 
-    #delete_indexes = sorted((i[0] for i in selection), reverse=True)
-    delete_indexes = sorted((j for i in selection for j in i[0]), reverse=True)
-    for i in delete_indexes:
-        #exec_queue.pop(i)
-        exec_queue_names.pop(i)
-        job_queue.pop(i)
+    # the pipeline removes the executables from exec_queue
+    for k in programs:
+        job_queue.remove(k)
 
     print('remaining job queue:')
     print(job_queue)
     print()
-    #break
 
-# wait all jobs to finish
-while len(real_job_queue):
+# jobs come back in the order they finish
+for job in pipeline.run(exec_queue, log_submit):
     try:
-        res = real_job_queue[0].result() # use result to block
+        res = job.result()
     except RuntimeJobFailureError:
-        print('failed job:', real_job_queue[0].job_id())
-    real_job_queue.pop(0)
+        print('failed job:', job.job_id())
+        # all attempts failed, schedule the programs again unless they have already been requeued too many times
+        dropped = set(program.index for program in hypervisor.requeue(job, exec_queue))
+        job_queue[0:0] = list(exec_index[id(program.executable)] for program in job.programs if program.index not in dropped)
+        if len(dropped):
+            print('dropped after too many failures:', list(circ_name_list[exec_index[id(program.executable)]] for program in job.programs if program.index in dropped))
     # write calibration data when a job finishes
     cal_file.write(str(score_all(hypervisor, vm_coupling_map)) + '\n')
     
@@ -4,6 +4,7 @@
 # 2. which quantum computer we are using
 # 3. which access token we are using
 from HypervisorBackend import *
+from qvm_partition import load_device_profile
 from vm_executable import *
 from qiskit import QuantumCircuit, transpile
 from qiskit_ibm_runtime import QiskitRuntimeService, RuntimeJobFailureError
@@ -63,20 +64,14 @@ real_sampler = Sampler(mode=real_backend)
 #backend = AerSimulator.from_backend(real_backend)
 backend = real_backend
 
-vm_coupling_map = [[1, 0], [0, 1], [1, 2], [2, 1], [1, 3], [3, 1], [3, 5], [5, 3], [4, 5], [5, 4], [5, 6], [6, 5]]
+# qvm partition of the device, computed from its coupling map and cached in device_profiles/
+profile = load_device_profile(real_backend)
+vm_coupling_map = profile.vm_coupling_map
 
-vms = [[[3, 4, 5, 15, 21, 22, 23], [7, 8, 9, 16, 25, 26, 27], [11, 12, 13, 17, 29, 30, 31]], 
-       [[40, 41, 42, 53, 59, 60, 61], [44, 45, 46, 54, 63, 64, 65], [48, 49, 50, 55, 67, 68, 69]], 
-       [[78, 79, 80, 91, 97, 98, 99], [82, 83, 84, 92, 101, 102, 103], [86, 87, 88, 93, 105, 106, 107]]]
+# vm qubit mappings
+vms, hc_backend, vc_backend = profile.vms, profile.hc_backend, profile.vc_backend
 
-hc_backend = [[[6, 24], [10, 28]], 
-              [[43, 62], [47, 66]],
-              [[81, 100], [85, 104]]]
-
-vc_backend = [[[20, 33, 39], [24, 34, 43], [28, 35, 47]],
-              [[58, 71, 77], [62, 72, 81], [66, 73, 85]]]
-
-hypervisor = HypervisorBackend(real_backend, vms, hc_backend, vc_backend)
+hypervisor = HypervisorBackend(real_backend, vms, hc_backend, vc_backend, calibration_ttl = 300)
 
 # get QASMbenchmark object
 path = "../QASMBench"
@@ -136,12 +131,15 @@ for i in range(len(circ_list)):
 
 # for real machine, just submit jobs, get results later
 
+# transpile all circuits before submission, qiskit compiles a list of circuits in parallel
+circ_transpiled_list = transpile(circ_list, backend)
+
 real_job_queue = []
 # add automatic job queue maintainance
 for i in range(len(circ_list)):
     if circ_name_list[i] in exclude_tests:
         continue
-    circ_transpiled = transpile(circ_list[i], backend)
+    circ_transpiled = circ_transpiled_list[i]
     if len(real_job_queue) == 3: # IBM Quantum allows at most 3 jobs in the queue
         try:
             res = real_job_queue[0].result() # use result to block
@@ -0,0 +1,56 @@
+# compare the latency of HypervisorBackend.combine (compose per sub-circuit) and HypervisorBackend.combine_fast (native relocation without copies)
+# runs offline on a fake ibm_brisbane with random circuits, checks that both produce the same circuit
+
+from HypervisorBackend import *
+from qvm_partition import load_device_profile
+from vm_executable import *
+from qiskit.circuit.random import random_circuit
+from qiskit_ibm_runtime.fake_provider import FakeBrisbane
+
+import random
+import sys
+import timeit
+
+if len(sys.argv) > 2:
+    print("usage: benchmark_combine.py [repeat]")
+    exit()
+repeat = int(sys.argv[1]) if len(sys.argv) == 2 else 20
+
+backend = FakeBrisbane()
+
+# create virtual backend
+basis_gates = backend.basis_gates #['ecr', 'id', 'rz', 'sx', 'x']
+# qvm partition of the device, computed from its coupling map and cached in device_profiles/
+profile = load_device_profile(backend)
+hc, vc, shared_up, shared_down = profile.hc, profile.vc, profile.shared_up, profile.shared_down
+vm_coupling_map = profile.vm_coupling_map
+allowed_dimensions = profile.allowed_dimensions
+
+# vm qubit mappings
+vms, hc_backend, vc_backend = profile.vms, profile.hc_backend, profile.vc_backend
+
+hypervisor = HypervisorBackend(backend, vms, hc_backend, vc_backend)
+
+random.seed(0)
+circ_list = []
+for i in range(40):
+    num_qubits = random.choice([2, 3, 5, 7, 10, 12])
+    circ_list.append(random_circuit(num_qubits, random.randint(5, 40), max_operands = 2, measure = True, seed = i))
+exec_list, compile_time = build_executables(circ_list, basis_gates, hc, vc, shared_up, shared_down, vm_coupling_map, allowed_dimensions, True, max_workers = 1)
+
+for time_sched in (False, True):
+    selection = hypervisor.schedule(exec_list, time_sched = time_sched, intra_vm_sched = True, noise_aware = False)
+    vcs = []
+    mappings = []
+    for i, r, c, n, m, v in selection:
+        if len(i) > 1:
+            continue
+        vcs.append(hypervisor.get_corrected_circuit(exec_list[i[0]], v, r, c, n, m))
+        mappings.append(hypervisor.get_mapping(r, c, n, m))
+
+    same = hypervisor.combine(vcs, mappings, backend.num_qubits, 'vm') == hypervisor.combine_fast(vcs, mappings, backend.num_qubits, 'vm')
+    t_compose = min(timeit.repeat(lambda: hypervisor.combine(vcs, mappings, backend.num_qubits, 'vm'), number = 1, repeat = repeat))
+    t_fast = min(timeit.repeat(lambda: hypervisor.combine_fast(vcs, mappings, backend.num_qubits, 'vm'), number = 1, repeat = repeat))
+    print('time_sched =', time_sched, 'programs =', len(vcs), 'instructions =', sum(len(vc.data) for vc in vcs), 'identical =', same)
+    print('combine:', t_compose, 's')
+    print('combine_fast:', t_fast, 's')
@@ -1,6 +1,8 @@
 # benchmark using the hypervisor backend
 from HypervisorBackend import *
+from qvm_partition import load_device_profile
 from vm_executable import *
+from TranspileCache import TranspileCache
 from qiskit import QuantumCircuit, transpile
 from qiskit_ibm_runtime import QiskitRuntimeService, RuntimeJobFailureError
 
@@ -69,27 +71,18 @@ backend = real_backend
 
 # create virtual backend
 basis_gates = real_backend.basis_gates #['ecr', 'id', 'rz', 'sx', 'x']
-hc = [(2, -2), (-2, 0), (6, -1), (-1, 4)]
-vc = [(4, -3), (-3, -2), (-2, -1), (-1, 0)]
-shared_up = {-3: -1}
-shared_down = {-1: -2}
-vm_coupling_map = [[1, 0], [0, 1], [1, 2], [2, 1], [1, 3], [3, 1], [3, 5], [5, 3], [4, 5], [5, 4], [5, 6], [6, 5]]
-allowed_dimensions = [(1, 1), (1, 2), (2, 1), (1, 3), (3, 1), (2, 2), (2, 3), (3, 2), (3, 3)]
+# qvm partition of the device, computed from its coupling map and cached in device_profiles/
+profile = load_device_profile(real_backend)
+hc, vc, shared_up, shared_down = profile.hc, profile.vc, profile.shared_up, profile.shared_down
+vm_coupling_map = profile.vm_coupling_map
+allowed_dimensions = profile.allowed_dimensions
 
 # vm qubit mappings
-vms = [[[3, 4, 5, 15, 21, 22, 23], [7, 8, 9, 16, 25, 26, 27], [11, 12, 13, 17, 29, 30, 31]], 
-       [[40, 41, 42, 53, 59, 60, 61], [44, 45, 46, 54, 63, 64, 65], [48, 49, 50, 55, 67, 68, 69]], 
-       [[78, 79, 80, 91, 97, 98, 99], [82, 83, 84, 92, 101, 102, 103], [86, 87, 88, 93, 105, 106, 107]]]
-
-hc_backend = [[[6, 24], [10, 28]], 
-              [[43, 62], [47, 66]],
-              [[81, 100], [85, 104]]]
-
-vc_backend = [[[20, 33, 39], [24, 34, 43], [28, 35, 47]],
-              [[58, 71, 77], [62, 72, 81], [66, 73, 85]]]
+vms, hc_backend, vc_backend = profile.vms, profile.hc_backend, profile.vc_backend
 
 # create hypervisor backend
-hypervisor = HypervisorBackend(backend, vms, hc_backend, vc_backend)
+# a failed batch is resubmitted once from its serialized copy with a longer rep_delay
+hypervisor = HypervisorBackend(backend, vms, hc_backend, vc_backend, retry_policy = RetryPolicy(max_attempts = 2, backoff = 0, retry_rep_delay = 0.0005), calibration_ttl = 300)
 
 # get QASMbenchmark object
 path = "../QASMBench"
@@ -109,12 +102,12 @@ circ_list_medium = list(bm_medium.get(i) for i in circ_name_list_medium)
 circ_name_list = circ_name_list_small + circ_name_list_medium
 circ_list = circ_list_small + circ_list_medium
 
-exec_list = []
-for i, circ in enumerate(circ_list):
-    evm = elastic_vm(circ.num_qubits, basis_gates, hc, vc, shared_up, shared_down, vm_coupling_map, allowed_dimensions)
-    #print('transpiling', circ_name_list[i])
-    exe = vm_executable(circ, evm, True)
-    exec_list.append(exe)
+# compiled circuits are cached on disk, so restarting the benchmark skips compilation
+transpile_cache = TranspileCache('transpile_cache')
+# compile all circuits in a process pool
+exec_list, compile_time = build_executables(circ_list, basis_gates, hc, vc, shared_up, shared_down, vm_coupling_map, allowed_dimensions, True, cache = transpile_cache)
+for i in range(len(circ_list)):
+    print('compiled', circ_name_list[i], 'in', compile_time[i], 's')
 
 exec_queue = list(exec_list[i] for i in job_queue)
 exec_queue_names = list(circ_name_list[i] for i in job_queue)
@@ -204,26 +197,44 @@ while len(exec_queue) or len(poisson_exec_queue):
         print(names)
 
         # run and get running time
-        poisson_exec_queue_backup = poisson_exec_queue[:]
+        submit_time = time.time()
         job = hypervisor.run(poisson_exec_queue, selection = selection, dynamic=True)
         print('batch', batch_cnt, job.job_id(), 'combined', sum(len(s[0]) for s in selection))
+        def log_retry(failed_job, new_job):
+            print('failed batch:', failed_job.job_id(), 'trying increasing rep_delay')
+            print('batch', batch_cnt, new_job.job_id(), 'combined', sum(len(s[0]) for s in selection))
+        job = hypervisor.wait(job, on_retry = log_retry)
         try:
             res = job.result()
         except RuntimeJobFailureError:
-            print('failed batch:', job.job_id(), 'trying increasing rep_delay')
-            job = hypervisor.run(poisson_exec_queue_backup, selection = selection, rep_delay=0.0005)
-            print('batch', batch_cnt, job.job_id(), 'combined', sum(len(s[0]) for s in selection))
-            try:
-                res = job.result()
-            except RuntimeJobFailureError:
-                print('failed batch:', job.job_id())
-        print('batch', batch_cnt, 'takes', job.job.result().metadata['execution']['execution_spans'].duration)
+            # every attempt failed, skip the batch and put its programs back to the front of the queue in the same order.
+            # Programs that were already requeued too many times are dropped, they never finish
+            print('failed batch:', job.job_id(), 'requeue its programs')
+            dropped = set(program.index for program in hypervisor.requeue(job, poisson_exec_queue))
+            programs = [j for i in selection for j in i[0]]
+            if len(dropped):
+                print('dropped after too many failures:', [poisson_exec_queue_names[j] for k, j in enumerate(programs) if k in dropped])
+            entries = [(poisson_exec_queue_names[j], poisson_job_queue[j], poisson_job_index[j]) for k, j in enumerate(programs) if k not in dropped]
+            for j in sorted(programs, reverse=True):
+                poisson_exec_queue_names.pop(j)
+                poisson_job_queue.pop(j)
+                poisson_job_index.pop(j)
+            poisson_exec_queue_names[0:0] = [entry[0] for entry in entries]
+            poisson_job_queue[0:0] = [entry[1] for entry in entries]
+            poisson_job_index[0:0] = [entry[2] for entry in entries]
+            batch_cnt += 1
+            continue
+        duration = job.duration()
+        if duration == None:
+            # no execution spans in the result (e.g. a local backend), use the wall time of the job instead
+            duration = time.time() - submit_time
+        print('batch', batch_cnt, 'takes', duration)
         # write calibration data when a job finishes
         cal_file.write(str(score_all(hypervisor, vm_coupling_map)) + '\n')
         # record job finish time
         for i in selection:
             for j in i[0]:
-                job_finish_time[poisson_job_index[j]] = t + job.job.result().metadata['execution']['execution_spans'].duration
+                job_finish_time[poisson_job_index[j]] = t + duration
 
 
         # delete entries from poisson queues
@@ -237,15 +248,15 @@ while len(exec_queue) or len(poisson_exec_queue):
 
         # simulate job arrivals while the last batch was running
         t1 = t
-        while t1 < t + job.job.result().metadata['execution']['execution_spans'].duration and len(poisson_exec_queue) < MAX_QUEUE_SIZE and job_cnt < tot_job_cnt:
+        while t1 < t + duration and len(poisson_exec_queue) < MAX_QUEUE_SIZE and job_cnt < tot_job_cnt:
             interval = random.expovariate(1/AVG_INTERVAL)
             t1 += interval
-            if t1 < t + job.job.result().metadata['execution']['execution_spans'].duration:
+            if t1 < t + duration:
                 print('job', job_cnt, 'arrives at time', t1)
                 job_arrive()
                 job_arrival_time.append(t1)
 
-        t += job.job.result().metadata['execution']['execution_spans'].duration
+        t += duration
         print('batch', batch_cnt, 'finishes at', t)
         batch_cnt += 1
     else: # if queue is empty, let the next job enqueue
@@ -256,4 +267,8 @@ while len(exec_queue) or len(poisson_exec_queue):
         job_arrive()
 
 save_status()
-print('average wait time', sum(j-i for (i, j) in zip(job_arrival_time, job_finish_time))/tot_job_cnt)        
+# dropped programs have no finish time
+finished = [(i, j) for (i, j) in zip(job_arrival_time, job_finish_time) if j >= 0]
+print('average wait time', sum(j-i for (i, j) in finished)/max(len(finished), 1))
+if len(finished) < tot_job_cnt:
+    print(tot_job_cnt - len(finished), 'jobs dropped after too many failures')        
@@ -0,0 +1,85 @@
+# offline version of benchmark_poisson.py: simulate the poisson arrival benchmark on a discrete event queue
+# with the timing model of a simulated ibm_brisbane, sweeping arrival intervals and scheduling strategies in parallel
+
+from HypervisorBackend import *
+from qvm_partition import load_device_profile
+from vm_executable import *
+from TranspileCache import TranspileCache
+from SimulatedDevice import SimulatedDevice
+from poisson_simulator import sweep, device_duration_model
+from qiskit_ibm_runtime.fake_provider import FakeBrisbane
+
+from qasmbench import QASMBenchmark
+
+import sys
+
+# we exclude circuits that has classical bit control which cause unknown error
+# some tests do not measure at the end of execution, we also exclude them.
+exclude_tests = {'ipea_n2', 'inverseqft_n4', 'vqe_uccsd_n4', 'pea_n5', 'qec_sm_n5', 'shor_n5', 'vqe_uccsd_n6', 'hhl_n7', 'sat_n7', 'vqe_uccsd_n8', 'qpe_n9', 'adder_n10', 'hhl_n10', 'cc_n12', 'hhl_n14', 'factor247_n15', 'bwt_n21', 'vqe_n24'}
+
+if len(sys.argv) < 2 or (sys.argv[1] != 'small' and sys.argv[1] != 'all'):
+    print("usage: benchmark_poisson_sim.py small/all [avg_interval ...]")
+    exit()
+workload_type = sys.argv[1]
+avg_intervals = list(float(i) for i in sys.argv[2:]) if len(sys.argv) > 2 else [0.5, 1, 2, 5, 10]
+
+# only test small for fidelity, 29 types of tests in total, each appears 5 times
+if workload_type == 'small':
+    job_queue = [25, 12, 20, 16, 17, 6, 26, 8, 4, 14, 11, 5, 27, 24, 28, 23, 9, 4, 8, 6, 7, 15, 1, 10, 4, 14, 23, 12, 5, 14, 27, 11, 7, 7, 7, 18, 12, 27, 14, 1, 19, 13, 24, 13, 15, 22, 20, 3, 26, 11, 4, 20, 20, 25, 1, 9, 25, 2, 16, 5, 10, 8, 3, 0, 9, 14, 6, 3, 19, 3, 0, 26, 8, 27, 2, 10, 21, 3, 8, 5, 18, 22, 18, 24, 19, 0, 17, 21, 25, 22, 6, 0, 18, 5, 23, 15, 12, 23, 24, 28, 0, 28, 16, 12, 25, 17, 26, 4, 22, 10, 18, 9, 17, 1, 13, 13, 13, 15, 20, 27, 24, 16, 26, 2, 19, 21, 28, 11, 19, 2, 15, 23, 16, 1, 9, 21, 21, 6, 11, 7, 22, 2, 28, 17, 10]
+else:
+# test a mix of small and medium for throughput. 29 + 20 = 49 tests, each appears 4 times
+    job_queue = [25, 45, 0, 30, 7, 8, 4, 14, 10, 2, 33, 5, 20, 19, 7, 6, 34, 43, 24, 46, 12, 25, 30, 15, 21, 5, 30, 21, 19, 39, 26, 26, 18, 32, 44, 9, 28, 10, 31, 22, 17, 42, 3, 3, 12, 37, 37, 9, 11, 5, 6, 48, 38, 8, 15, 22, 0, 32, 41, 48, 23, 25, 40, 29, 42, 22, 41, 12, 33, 4, 20, 19, 20, 2, 35, 33, 21, 13, 0, 29, 47, 24, 35, 24, 31, 5, 25, 35, 18, 43, 41, 34, 11, 4, 2, 11, 1, 31, 46, 1, 47, 30, 41, 32, 10, 31, 12, 42, 16, 2, 15, 29, 11, 37, 42, 27, 36, 16, 48, 17, 1, 40, 36, 6, 47, 38, 26, 23, 3, 44, 26, 36, 44, 36, 40, 39, 37, 19, 20, 45, 16, 46, 13, 23, 17, 35, 8, 23, 34, 24, 21, 48, 27, 34, 10, 39, 40, 0, 7, 33, 28, 16, 32, 18, 17, 38, 18, 39, 47, 27, 8, 27, 6, 14, 45, 28, 4, 9, 46, 29, 28, 13, 45, 13, 43, 7, 9, 15, 43, 14, 1, 22, 44, 14, 3, 38]
+
+backend = FakeBrisbane()
+
+# create virtual backend
+basis_gates = backend.basis_gates #['ecr', 'id', 'rz', 'sx', 'x']
+# qvm partition of the device, computed from its coupling map and cached in device_profiles/
+profile = load_device_profile(backend)
+hc, vc, shared_up, shared_down = profile.hc, profile.vc, profile.shared_up, profile.shared_down
+vm_coupling_map = profile.vm_coupling_map
+allowed_dimensions = profile.allowed_dimensions
+
+# vm qubit mappings
+vms, hc_backend, vc_backend = profile.vms, profile.hc_backend, profile.vc_backend
+
+# create hypervisor backend
+hypervisor = HypervisorBackend(backend, vms, hc_backend, vc_backend, sampler = SimulatedDevice(backend))
+
+# get QASMbenchmark object
+path = "../QASMBench"
+remove_final_measurements = False # do not remove the final measurement for real benchmark
+do_transpile = False
+transpile_args = {}
+bm_small = QASMBenchmark(path, 'small', remove_final_measurements=remove_final_measurements, do_transpile=do_transpile, **transpile_args)
+bm_medium = QASMBenchmark(path, 'medium', remove_final_measurements=remove_final_measurements, do_transpile=do_transpile, **transpile_args)
+
+# use the .get method instead of .circ_name to avoid getting the large unusable circuits to save time
+circ_name_list_small = list(i for i in bm_small.circ_name_list if i not in exclude_tests)
+circ_list_small = list(bm_small.get(i) for i in circ_name_list_small)
+
+circ_name_list_medium = list(i for i in bm_medium.circ_name_list if i not in exclude_tests)
+circ_list_medium = list(bm_medium.get(i) for i in circ_name_list_medium)
+
+circ_name_list = circ_name_list_small + circ_name_list_medium
+circ_list = circ_list_small + circ_list_medium
+
+# compiled circuits are cached on disk, so restarting the benchmark skips compilation
+transpile_cache = TranspileCache('transpile_cache')
+# compile all circuits in a process pool
+exec_list, compile_time = build_executables(circ_list, basis_gates, hc, vc, shared_up, shared_down, vm_coupling_map, allowed_dimensions, True, cache = transpile_cache)
+for i in range(len(circ_list)):
+    print('compiled', circ_name_list[i], 'in', compile_time[i], 's')
+
+exec_queue = list(exec_list[i] for i in job_queue)
+
+# time each batch with the timing model of the simulated device (use poisson_simulator.metrics_duration_model() to skip combining)
+duration_model = device_duration_model(hypervisor.sampler, shots = 4096)
+# the options stand for time scheduling, intra vm scheduling (fractional qVM), noise aware scheduling and placement by estimated success probability
+flag_sets = [{'intra_vm_sched': True}, {'time_sched': True, 'intra_vm_sched': True}, {'noise_aware': True}, {'intra_vm_sched': True, 'fidelity_aware': True}]
+MAX_QUEUE_SIZE = 99999
+
+results = sweep(hypervisor, exec_queue, duration_model, avg_intervals, flag_sets, seeds = [0, 1, 2], max_queue_size = MAX_QUEUE_SIZE)
+for avg_interval, flags, seed, report in results:
+    print('AVG_INTERVAL', avg_interval, flags, 'seed', seed)
+    print(report)
@@ -0,0 +1,202 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import itertools
+import heapq
+import random
+import os
+import numpy as np
+
+'''
+Discrete-event simulation of the poisson arrival benchmark (benchmark_poisson.py) without running anything on a device.
+Programs arrive one by one with exponentially distributed intervals. Whenever the device is idle and the queue is not empty,
+HypervisorBackend.schedule picks a batch from the queue and the device is busy for the time given by the duration model.
+Programs arriving in the meantime wait in the queue.
+
+A duration model is a function (hypervisor, executables, selection) -> seconds, where executables is the queue at
+scheduling time and selection is the output of schedule on it.
+'''
+
+'''
+device_duration_model: combine the batch and time the combined circuit with the timing model of a SimulatedDevice
+@ device: a SimulatedDevice
+@ shots: shots per batch
+@ rep_delay: defaults to the rep_delay of the device
+'''
+
+def device_duration_model(device, shots = 4096, rep_delay = None):
+    def model(hypervisor, executables, selection) -> float:
+        circ = hypervisor.build_circuit(executables, selection)[0]
+        return device.pub_time(circ, shots, rep_delay if rep_delay != None else device.rep_delay)
+    return model
+
+'''
+metrics_duration_model: estimate the duration from the metrics of the selected versions without building the circuit.
+Programs on different qvms run in parallel, programs stacked on the same qvm (time scheduling) run one after another.
+Programs sharing a qvm (intra-vm scheduling) run in parallel on their sub-regions, one after another on the same sub-region (see HypervisorBackend.internal_layout).
+@ shots, rep_delay, shot_overhead, pub_overhead: same as SimulatedDevice
+@ layer_time: time of one layer of the circuit, used when the metrics have no duration (compiled without a target)
+'''
+
+def metrics_duration_model(shots = 4096, rep_delay = 250e-6, shot_overhead = 20e-6, pub_overhead = 0.5, layer_time = 660e-9):
+    def circuit_time(metrics) -> float:
+        return metrics.duration if metrics.duration != None else metrics.depth*layer_time
+
+    def model(hypervisor, executables, selection) -> float:
+        cell_time = {}
+        for i, r, c, n, m, v in selection:
+            if len(i) > 1:
+                partition_time = {}
+                for j, (p, k, region) in zip(i, hypervisor.internal_layout([executables[j] for j in i])):
+                    partition_time[p] = partition_time.get(p, 0.0) + circuit_time(executables[j].sub_metrics[k])
+                duration = max(partition_time.values())
+            else:
+                duration = circuit_time(executables[i[0]].metrics[v])
+            cells = [(a, b) for a in range(r, r+n) for b in range(c, c+m)]
+            end = max(cell_time.get(cell, 0.0) for cell in cells) + duration
+            for cell in cells:
+                cell_time[cell] = end
+        return pub_overhead + shots*(max(cell_time.values(), default = 0.0) + rep_delay + shot_overhead)
+    return model
+
+# smallest value whose cumulative weight reaches q of the total weight
+def weighted_percentile(values, weights, q) -> float:
+    if len(values) == 0:
+        return 0.0
+    order = np.argsort(values, kind = 'stable')
+    values = np.asarray(values, dtype = float)[order]
+    cumulative = np.cumsum(np.asarray(weights, dtype = float)[order])
+    if cumulative[-1] <= 0:
+        return float(values[-1])
+    return float(values[np.searchsorted(cumulative, q*cumulative[-1])])
+
+'''
+simulate: run the poisson benchmark on the event queue and return a report (dict)
+@ hypervisor: a HypervisorBackend, only schedule (and build_circuit, depending on the duration model) is used
+@ executables: programs in arrival order
+@ avg_interval: average interval between arrivals in seconds
+@ duration_model: see above
+@ time_sched, intra_vm_sched, noise_aware, packing, packing_budget, fidelity_aware, guard_band: passed to HypervisorBackend.schedule
+@ max_queue_size: while the queue is full, the next arrival is postponed until a batch finishes (as in benchmark_poisson.py)
+@ seed: seed of the arrival times
+
+report: jobs, batches, makespan, throughput (jobs per second), utilization (fraction of the time the device is busy),
+qvm_utilization (fraction of qvm-seconds occupied), turnaround (finish - arrival, the "wait time" of benchmark_poisson.py)
+and queueing (start - arrival) mean and percentiles, queue length mean / percentiles (time weighted) / max
+'''
+
+def simulate(hypervisor, executables, avg_interval, duration_model, time_sched = False, intra_vm_sched = False, noise_aware = False,
+             packing = False, packing_budget = 1.0, fidelity_aware = False, guard_band = False, max_queue_size = None, seed = None) -> dict:
+    rng = random.Random(seed)
+    tot_job_cnt = len(executables)
+    arrival_time = [None]*tot_job_cnt
+    start_time = [None]*tot_job_cnt
+    finish_time = [None]*tot_job_cnt
+    queue = [] # indexes of waiting programs in executables
+    events = [] # (time, sequence number, kind)
+    sequence = itertools.count()
+    job_cnt = 0 # programs arrived so far
+    busy = False
+    postponed = False # an arrival is waiting for space in the queue
+    busy_time = 0.0
+    qvm_time = 0.0
+    batch_cnt = 0
+    queue_lengths = []
+    queue_weights = []
+    last_t = 0.0
+
+    def next_arrival(t):
+        if job_cnt < tot_job_cnt:
+            heapq.heappush(events, (t + rng.expovariate(1/avg_interval), next(sequence), 'arrival'))
+
+    next_arrival(0.0)
+    while len(events):
+        t, _, kind = heapq.heappop(events)
+        queue_lengths.append(len(queue))
+        queue_weights.append(t - last_t)
+        last_t = t
+
+        if kind == 'arrival':
+            if max_queue_size != None and len(queue) >= max_queue_size:
+                postponed = True
+            else:
+                arrival_time[job_cnt] = t
+                queue.append(job_cnt)
+                job_cnt += 1
+                next_arrival(t)
+        else: # a batch finishes
+            busy = False
+            if postponed:
+                postponed = False
+                next_arrival(t)
+
+        if not busy and len(queue):
+            queued_executables = [executables[j] for j in queue]
+            selection = hypervisor.schedule(queued_executables, time_sched, intra_vm_sched, noise_aware, packing, packing_budget, fidelity_aware, guard_band)
+            if len(selection) == 0:
+                raise ValueError('no executable in the queue fits the backend')
+            duration = duration_model(hypervisor, queued_executables, selection)
+            delete_indexes = sorted((j for i in selection for j in i[0]), reverse = True)
+            for i in delete_indexes:
+                job = queue.pop(i)
+                start_time[job] = t
+                finish_time[job] = t + duration
+            busy = True
+            heapq.heappush(events, (t + duration, next(sequence), 'finish'))
+            busy_time += duration
+            occupied = set((a, b) for i, r, c, n, m, v in selection for a in range(r, r+n) for b in range(c, c+m))
+            qvm_time += duration*len(occupied)/(hypervisor.rows*hypervisor.cols)
+            batch_cnt += 1
+
+    makespan = last_t
+    turnaround = [f - a for a, f in zip(arrival_time, finish_time)]
+    queueing = [s - a for a, s in zip(arrival_time, start_time)]
+    report = {'jobs': tot_job_cnt, 'batches': batch_cnt, 'makespan': makespan,
+              'throughput': tot_job_cnt/makespan if makespan > 0 else 0.0,
+              'utilization': busy_time/makespan if makespan > 0 else 0.0,
+              'qvm_utilization': qvm_time/makespan if makespan > 0 else 0.0}
+    for name, values in (('turnaround', turnaround), ('queueing', queueing)):
+        report[name + '_mean'] = float(np.mean(values)) if len(values) else 0.0
+        for q in (50, 95, 99):
+            report[name + f'_p{q}'] = float(np.percentile(values, q)) if len(values) else 0.0
+    report['queue_length_mean'] = float(np.average(queue_lengths, weights = queue_weights)) if makespan > 0 else 0.0
+    for q in (50, 95, 99):
+        report[f'queue_length_p{q}'] = weighted_percentile(queue_lengths, queue_weights, q/100)
+    report['queue_length_max'] = max(queue_lengths, default = 0)
+    return report
+
+'''
+sweep: simulate every combination of arrival interval, scheduling flags and seed in a process pool.
+Return [(avg_interval, flags, seed, report)] in the order of the combinations.
+@ hypervisor, executables, duration_model, max_queue_size: same as simulate
+@ avg_intervals: list of average arrival intervals
+@ flag_sets: list of dicts of scheduling flags, e.g. [{'intra_vm_sched': True}, {'time_sched': True, 'intra_vm_sched': True}]
+@ seeds: seeds of the arrival times, every combination is simulated once per seed
+@ max_workers: number of processes, defaults to the number of cpus. Use 1 to simulate in the current process.
+'''
+
+# hypervisor, executables, duration model and max queue size of the running sweep, inherited by the forked workers
+sweep_context = None
+
+def sweep(hypervisor, executables, duration_model, avg_intervals, flag_sets = [{}], seeds = [0], max_queue_size = None, max_workers = None) -> [tuple]:
+    global sweep_context
+    sweep_context = (hypervisor, executables, duration_model, max_queue_size)
+    tasks = [(avg_interval, flags, seed) for avg_interval in avg_intervals for flags in flag_sets for seed in seeds]
+    if max_workers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        reports = list(map(simulate_task, tasks))
+    else:
+        # the hypervisor and the duration model are not picklable, workers get them by forking
+        mp_context = multiprocessing.get_context('fork')
+        previous_in_parallel = os.environ.get('QISKIT_IN_PARALLEL', 'FALSE')
+        os.environ['QISKIT_IN_PARALLEL'] = 'TRUE'
+        try:
+            with ProcessPoolExecutor(max_workers = max_workers, mp_context = mp_context) as executor:
+                reports = list(executor.map(simulate_task, tasks))
+        finally:
+            os.environ['QISKIT_IN_PARALLEL'] = previous_in_parallel
+    return [task + (report,) for task, report in zip(tasks, reports)]
+
+# worker of sweep
+def simulate_task(task) -> dict:
+    avg_interval, flags, seed = task
+    hypervisor, executables, duration_model, max_queue_size = sweep_context
+    return simulate(hypervisor, executables, avg_interval, duration_model, max_queue_size = max_queue_size, seed = seed, **flags)
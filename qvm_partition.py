@@ -0,0 +1,186 @@
+from collections import namedtuple
+import hashlib
+import json
+import os
+
+'''
+Automatic qvm partitioning of heavy-hex devices.
+The qubits of IBM heavy-hex devices are numbered row by row: a row is a chain of consecutive qubit numbers
+and rows are linked by bridge qubits that have no neighbour with a consecutive number.
+A basic qvm is a bridge with the qubit on each side of its two ends (7 qubits):
+    t-1 - t - t+1
+          |
+          b
+          |
+    u-1 - u - u+1
+Basic qvms of the same pair of rows are 4 columns apart and joined by the horizontal connection (t+2, u+2).
+Two basic qvms in the same column, 2 rows apart, are joined by the vertical connection (u-2, bridge, t'-2) where t' is the center of the top row of the lower qvm.
+'''
+
+# templates of the basic qvm, horizontal and vertical connections above, see elastic_vm for their format
+HEAVY_HEX_VM_COUPLING_MAP = [[1, 0], [0, 1], [1, 2], [2, 1], [1, 3], [3, 1], [3, 5], [5, 3], [4, 5], [5, 4], [5, 6], [6, 5]]
+HEAVY_HEX_HC = [(2, -2), (-2, 0), (6, -1), (-1, 4)]
+HEAVY_HEX_VC = [(4, -3), (-3, -2), (-2, -1), (-1, 0)]
+HEAVY_HEX_SHARED_UP = {-3: -1}
+HEAVY_HEX_SHARED_DOWN = {-1: -2}
+
+'''
+device_profile: qvm partition of a device
+@ vms, hc_backend, vc_backend: physical qubits of every basic qvm, horizontal and vertical connection, pass them to HypervisorBackend
+@ hc, vc, shared_up, shared_down, vm_coupling_map, allowed_dimensions: templates passed to elastic_vm / build_executables
+'''
+device_profile = namedtuple('device_profile', ['vms', 'hc_backend', 'vc_backend', 'hc', 'vc', 'shared_up', 'shared_down', 'vm_coupling_map', 'allowed_dimensions'])
+
+'''
+partition_heavy_hex: find the largest grid of basic qvms on a heavy-hex coupling map.
+Raise ValueError if no basic qvm fits.
+@ coupling_map: a CouplingMap or a list of edges
+'''
+
+def partition_heavy_hex(coupling_map) -> device_profile:
+    edges = coupling_map.get_edges() if hasattr(coupling_map, 'get_edges') else coupling_map
+    neighbours = {}
+    for q1, q2 in edges:
+        neighbours.setdefault(q1, set()).add(q2)
+        neighbours.setdefault(q2, set()).add(q1)
+
+    # segments: chains of consecutive qubit numbers, a row is split into several segments by a missing coupler
+    segments = []
+    segment_of = {} # qubit -> segment index
+    for q in sorted(neighbours):
+        if q-1 in neighbours[q]:
+            segments[segment_of[q-1]].append(q)
+            segment_of[q] = segment_of[q-1]
+        elif q+1 in neighbours[q]:
+            segment_of[q] = len(segments)
+            segments.append([q])
+
+    # bridges: qubits outside the segments linking an upper (lower numbers) and a lower segment
+    bridges = [] # (bridge, upper qubit, lower qubit)
+    for q in sorted(neighbours):
+        if q in segment_of or len(neighbours[q]) != 2:
+            continue
+        a, c = sorted(neighbours[q])
+        if a in segment_of and c in segment_of and segment_of[a] != segment_of[c]:
+            bridges.append((q, a, c))
+
+    # place the segments on a grid of (row, column) starting from the first one, bridges are vertical
+    place = {} # segment index -> (row, column of its first qubit)
+    if len(segments):
+        place[0] = (0, 0)
+    stack = list(place)
+    while len(stack):
+        s = stack.pop()
+        row, column = place[s]
+        for b, a, c in bridges:
+            for q, other, direction in ((a, c, 1), (c, a, -1)):
+                if segment_of[q] == s and segment_of[other] not in place:
+                    x = column + segments[s].index(q)
+                    place[segment_of[other]] = (row + direction, x - segments[segment_of[other]].index(other))
+                    stack.append(segment_of[other])
+
+    at = {} # (row, column) -> qubit
+    for s, (row, column) in place.items():
+        for i, q in enumerate(segments[s]):
+            at[(row, column + i)] = q
+    coordinate = {q: key for key, q in at.items()}
+    bridge_at = {} # (row, column) -> bridge between (row, column) and (row+1, column)
+    for b, a, c in bridges:
+        if a in coordinate and c in coordinate and coordinate[c] == (coordinate[a][0] + 1, coordinate[a][1]):
+            bridge_at[coordinate[a]] = b
+
+    def pos(k, x):
+        return at.get((k, x))
+
+    # check the edges of a template, negative qubits are in middle and other qubits in left (first qubit) or right (second qubit)
+    def linked(left, middle, right, template) -> bool:
+        for l, r in template:
+            l = middle[l] if l < 0 else left[l]
+            r = middle[r] if r < 0 else right[r]
+            if r not in neighbours[l]:
+                return False
+        return True
+
+    # qubits of the basic qvm with its top row on row k and its bridge on column x, in the order of the template
+    def cell(k, x):
+        qubits = [pos(k, x-1), pos(k, x), pos(k, x+1), bridge_at.get((k, x)), pos(k+1, x-1), pos(k+1, x), pos(k+1, x+1)]
+        if None in qubits or not linked(qubits, [], qubits, HEAVY_HEX_VM_COUPLING_MAP):
+            return None
+        return qubits
+
+    # horizontal connection between the basic qvms at (k, x) and (k, x+4)
+    def horizontal(k, x):
+        qubits = [pos(k, x+2), pos(k+1, x+2)]
+        if None in qubits or cell(k, x) == None or cell(k, x+4) == None or not linked(cell(k, x), qubits, cell(k, x+4), HEAVY_HEX_HC):
+            return None
+        return qubits
+
+    # vertical connection between the basic qvms at (k, x) and (k+2, x)
+    def vertical(k, x):
+        qubits = [pos(k+1, x-2), bridge_at.get((k+1, x-2)), pos(k+2, x-2)]
+        if None in qubits or cell(k, x) == None or cell(k+2, x) == None or not linked(cell(k, x), qubits, cell(k+2, x), HEAVY_HEX_VC):
+            return None
+        return qubits
+
+    # grid rows are pairs of device rows, grid columns are 4 apart. Search the largest rectangle, the first one found wins ties.
+    rows = [k for k, x in at]
+    columns = [x for k, x in at]
+    best = None # (area, top rows of the grid rows, columns)
+    for start in (min(rows, default = 0), min(rows, default = 0) + 1):
+        pairs = list(range(start, max(rows, default = 0), 2))
+        for i0 in range(len(pairs)):
+            for x0 in range(min(columns, default = 0), max(columns, default = -1) + 1):
+                # columns of the first grid row
+                xs = []
+                x = x0
+                while cell(pairs[i0], x) != None and (len(xs) == 0 or horizontal(pairs[i0], x-4) != None):
+                    xs.append(x)
+                    x += 4
+                ks = []
+                for k in pairs[i0:]:
+                    m = 0
+                    while m < len(xs) and cell(k, xs[m]) != None and (m == 0 or horizontal(k, xs[m-1]) != None) \
+                            and (len(ks) == 0 or vertical(ks[-1], xs[m]) != None):
+                        m += 1
+                    if m == 0:
+                        break
+                    xs = xs[:m]
+                    ks.append(k)
+                    if best == None or len(ks)*len(xs) > best[0]:
+                        best = (len(ks)*len(xs), list(ks), list(xs))
+
+    if best == None:
+        raise ValueError('no basic qvm fits the coupling map, is it a heavy-hex device?')
+    _, ks, xs = best
+    vms = [[cell(k, x) for x in xs] for k in ks]
+    hc_backend = [[horizontal(k, x) for x in xs[:-1]] for k in ks]
+    vc_backend = [[vertical(k, x) for x in xs] for k in ks[:-1]]
+    allowed_dimensions = sorted(((n, m) for n in range(1, len(ks)+1) for m in range(1, len(xs)+1)), key = lambda d: (d[0]*d[1], d[0]))
+    return device_profile(vms, hc_backend, vc_backend, list(HEAVY_HEX_HC), list(HEAVY_HEX_VC), dict(HEAVY_HEX_SHARED_UP), dict(HEAVY_HEX_SHARED_DOWN),
+                          [list(edge) for edge in HEAVY_HEX_VM_COUPLING_MAP], allowed_dimensions)
+
+'''
+load_device_profile: partition of backend, cached as <path>/<backend name>.json.
+The cached profile is used as long as the coupling map of the backend is the same.
+@ backend: the device
+@ path: directory of the profiles, created if it does not exist
+'''
+
+def load_device_profile(backend, path = 'device_profiles') -> device_profile:
+    edges = sorted(tuple(edge) for edge in backend.coupling_map.get_edges())
+    coupling_map_hash = hashlib.sha256(str(edges).encode()).hexdigest()
+    file_name = os.path.join(path, f'{backend.name}.json')
+    if os.path.exists(file_name):
+        with open(file_name) as f:
+            data = json.load(f)
+        if data.get('coupling_map_hash') == coupling_map_hash:
+            return device_profile(data['vms'], data['hc_backend'], data['vc_backend'],
+                                  [tuple(edge) for edge in data['hc']], [tuple(edge) for edge in data['vc']],
+                                  {int(q): v for q, v in data['shared_up'].items()}, {int(q): v for q, v in data['shared_down'].items()},
+                                  data['vm_coupling_map'], [tuple(d) for d in data['allowed_dimensions']])
+
+    profile = partition_heavy_hex(edges)
+    os.makedirs(path, exist_ok = True)
+    with open(file_name, 'w') as f:
+        json.dump({'backend': backend.name, 'coupling_map_hash': coupling_map_hash, **profile._asdict()}, f)
+    return profile
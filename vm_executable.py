@@ -1,34 +1,311 @@
 from qiskit import transpile
+from qiskit.circuit.library import get_standard_gate_name_mapping
 from qiskit.providers.fake_provider import GenericBackendV2
+from collections import namedtuple
+import itertools
+import threading
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 '''
 @ qc: "source circuit" (uncompiled circuit)
 @ virtual_backend_list: a list of vm configurations, which can be generated by function elastic_vm
 @ allow_intra_sched: whether the user permits this program to share a qvm with others,
-currently only program less than 3 qubits is allowed
+only programs of at most SUB_VM_MAX_SIZE qubits can share a qvm
+@ cache: a TranspileCache, compiled versions are read from / written to it instead of calling transpile directly
+@ lazy, speculative: see vm_executable below
 '''
 
-HALF_VM_SIZE = 3
-half_vm_coupling_map = [[0, 1], [1, 0], [1, 2], [2, 1]]
+# programs sharing a qvm (intra-vm scheduling) run on a connected sub-region of the basic qvm of at most this many qubits
+SUB_VM_MAX_SIZE = 4
 
-def half_vm(basis_gates: [str], coupling_map):
-    return GenericBackendV2(HALF_VM_SIZE, basis_gates = basis_gates, coupling_map = coupling_map, control_flow = True)
+# virtual backends shared by all executables, {key: backend}. The key describes the topology and shape of the vm.
+# Creating GenericBackendV2 objects is expensive, so each one is built once when first needed.
+virtual_backend_registry = {}
+virtual_backend_registry_lock = threading.Lock()
+
+# a process forked while another thread holds the lock (e.g. a speculative compilation) would never get it
+def reset_registry_lock():
+    global virtual_backend_registry_lock
+    virtual_backend_registry_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child = reset_registry_lock)
+
+def get_virtual_backend(key, build):
+    with virtual_backend_registry_lock:
+        if key not in virtual_backend_registry:
+            virtual_backend_registry[key] = build()
+        return virtual_backend_registry[key]
+
+# virtual backend of a sub-region shape. A single qubit has no coupling map and cannot have multi-qubit basis gates
+def sub_vm(basis_gates: [str], num_qubits, coupling_map):
+    key = ('sub_vm', tuple(basis_gates), num_qubits, tuple(tuple(edge) for edge in coupling_map))
+    if num_qubits == 1:
+        gates = get_standard_gate_name_mapping()
+        basis_gates = [gate for gate in basis_gates if gate not in gates or gates[gate].num_qubits <= 1]
+    return get_virtual_backend(key, lambda: GenericBackendV2(num_qubits, basis_gates = list(basis_gates),
+                                                             coupling_map = coupling_map if num_qubits > 1 else None, control_flow = True))
+
+'''
+sub_vm_shape: a shape of connected sub-regions of the basic qvm, small programs are compiled once per shape
+@ num_qubits
+@ coupling_map: coupling map of the shape (both directions of every link), the target of the compilation
+@ regions: every sub-region of the basic qvm with this shape, regions[i][q] is the qvm qubit used by qubit q of the shape.
+Regions made of low degree qubits come first, so the first fits leave the better connected qubits to other programs.
+'''
+sub_vm_shape = namedtuple('sub_vm_shape', ['num_qubits', 'coupling_map', 'regions'])
+
+sub_vm_shape_cache = {} # {(edges of the basic qvm, max_size): [sub_vm_shape]}
+
+# every shape of the connected sub-regions of up to max_size qubits of a basic qvm, by number of qubits
+def sub_vm_shapes(vm_coupling_map, max_size = SUB_VM_MAX_SIZE) -> [sub_vm_shape]:
+    edges = sorted(set((min(q1, q2), max(q1, q2)) for q1, q2 in vm_coupling_map if q1 != q2))
+    key = (tuple(edges), max_size)
+    if key in sub_vm_shape_cache:
+        return sub_vm_shape_cache[key]
+
+    neighbours = {}
+    for q1, q2 in edges:
+        neighbours.setdefault(q1, set()).add(q2)
+        neighbours.setdefault(q2, set()).add(q1)
+
+    def connected(qubits) -> bool:
+        reached = {qubits[0]}
+        stack = [qubits[0]]
+        while len(stack):
+            for q in neighbours[stack.pop()] & set(qubits):
+                if q not in reached:
+                    reached.add(q)
+                    stack.append(q)
+        return len(reached) == len(qubits)
+
+    # links of a region with its qubits in the given order, as pairs of shape qubits
+    def links(order) -> tuple:
+        index = {q: k for k, q in enumerate(order)}
+        return tuple(sorted((min(index[q1], index[q2]), max(index[q1], index[q2])) for q1, q2 in edges if q1 in index and q2 in index))
+
+    shapes = []
+    for size in range(1, min(max_size, len(neighbours)) + 1):
+        subsets = [qubits for qubits in itertools.combinations(sorted(neighbours), size) if connected(qubits)]
+        subsets.sort(key = lambda qubits: (sum(len(neighbours[q]) for q in qubits), qubits))
+        groups = {} # {smallest links over all orders: (links of the first region, regions)}
+        for qubits in subsets:
+            invariant = min(links(order) for order in itertools.permutations(qubits))
+            if invariant not in groups:
+                groups[invariant] = (links(qubits), [])
+            shape_links, regions = groups[invariant]
+            regions.append(next(order for order in itertools.permutations(qubits) if links(order) == shape_links))
+        for shape_links, regions in groups.values():
+            coupling_map = [list(edge) for q1, q2 in shape_links for edge in ((q1, q2), (q2, q1))]
+            shapes.append(sub_vm_shape(size, coupling_map, regions))
+    sub_vm_shape_cache[key] = shapes
+    return shapes
+
+'''
+circuit_metrics: what the schedulers need to know about a compiled circuit, computed once per compiled version
+@ depth: qc.depth()
+@ size: total number of operations (sum of qc.count_ops())
+@ ops: qc.count_ops() as a dict
+@ duration: estimated execution time in seconds (critical path with the instruction durations of the target),
+None if the target has no duration information
+'''
+circuit_metrics = namedtuple('circuit_metrics', ['depth', 'size', 'ops', 'duration'])
+
+def get_metrics(qc, target = None) -> circuit_metrics:
+    ops = dict(qc.count_ops())
+    return circuit_metrics(qc.depth(), sum(ops.values()), ops, estimate_duration(qc, target))
+
+# longest path through the circuit, each instruction takes the duration given by the target
+def estimate_duration(qc, target) -> float:
+    if target is None:
+        return None
+    qubit_index = {q: i for i, q in enumerate(qc.qubits)}
+    finish_time = [0.0]*qc.num_qubits
+    for inst in qc.data:
+        qargs = tuple(qubit_index[q] for q in inst.qubits)
+        if len(qargs) == 0:
+            continue
+        duration = 0.0
+        name = inst.operation.name
+        if name in target and qargs in target[name]:
+            props = target[name][qargs]
+            if props is not None and props.duration is not None:
+                duration = props.duration
+        end = max(finish_time[q] for q in qargs) + duration
+        for q in qargs:
+            finish_time[q] = end
+    return max(finish_time, default=0.0)
+
+# gate counts of a circuit for the estimated success probability (see HypervisorBackend.esp), a vector of length 2*N + N*N
+# (N = qc.num_qubits): single-qubit gates on each qubit, measurements of each qubit, two-qubit gates on each pair (i < j, row major).
+# rz is a virtual gate without error, resets, barriers, delays and control flow are not counted.
+UNCOUNTED_GATES = ('rz', 'reset', 'barrier', 'delay')
+
+def gate_counts(qc) -> np.ndarray:
+    num_qubits = qc.num_qubits
+    qubit_index = {q: i for i, q in enumerate(qc.qubits)}
+    one_qubit = np.zeros(num_qubits)
+    measure = np.zeros(num_qubits)
+    two_qubit = np.zeros((num_qubits, num_qubits))
+    for inst in qc.data:
+        name = inst.operation.name
+        if name in UNCOUNTED_GATES or getattr(inst.operation, 'blocks', ()):
+            continue
+        qargs = [qubit_index[q] for q in inst.qubits]
+        if name == 'measure':
+            measure[qargs[0]] += 1
+        elif len(qargs) == 1:
+            one_qubit[qargs[0]] += 1
+        elif len(qargs) == 2:
+            two_qubit[min(qargs), max(qargs)] += 1
+    return np.concatenate([one_qubit, measure, two_qubit.ravel()])
+
+# a read-only list whose items are produced by get(index) when accessed
+class lazy_list:
+    def __init__(self, get, length):
+        self.get = get
+        self.length = length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError('lazy_list index out of range')
+        return self.get(index)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return (self.get(i) for i in range(self.length))
+
+# before a version is compiled, the schedulers use the metrics of the source circuit scaled by this factor
+# (decomposition to basis gates and routing make the compiled circuit deeper)
+ESTIMATE_SCALE = 3
+
+# background thread compiling the executables created with speculative = True
+speculative_executor = None
+
+def get_speculative_executor() -> ThreadPoolExecutor:
+    global speculative_executor
+    with virtual_backend_registry_lock:
+        if speculative_executor == None:
+            speculative_executor = ThreadPoolExecutor(max_workers = 1)
+        return speculative_executor
+
+'''
+vm_executable: a program compiled to every version in virtual_backend_list (and to every sub-region shape of its size if it can share a qvm)
+@ lazy: compile a version on first access of qc[v] / sub_qc[k] instead of in the constructor.
+Until then, metrics[v] and sub_metrics[k] are estimates made from the source circuit.
+@ speculative: with lazy = True, compile all versions in a background thread right away
+'''
 
 class vm_executable:
-    def __init__(self, qc, virtual_backend_list: [('Backend', 'row', 'col')], allow_intra_sched):
+    def __init__(self, qc, virtual_backend_list: [('Backend', 'row', 'col')], allow_intra_sched, cache = None, lazy = False, speculative = False):
+        self.cache = cache
         # for intra-vm scheduling, we may need the uncompiled circuit
         self.source_qc = qc
         self.allow_intra_sched = allow_intra_sched
-        self.half_qc = None
         self.basis_gates = virtual_backend_list[0][0]._basis_gates
-        if allow_intra_sched and qc.num_qubits <= HALF_VM_SIZE:
-            self.half_qc = transpile(qc, half_vm(self.basis_gates, half_vm_coupling_map))
-        
-        self.qc = []
+
         self.dimensions = []
         self.vbl = virtual_backend_list
         for vb in virtual_backend_list: # at most 2 versions
-            self.qc.append(transpile(qc, vb[0]))
             self.dimensions.append((vb[1], vb[2]))
         self.versions = len(virtual_backend_list)
         self.clbits = qc.num_clbits
-        
+
+        # the shapes of the sub-regions of the basic qvm (the 1*1 version) with as many qubits as the program
+        self.sub_shapes = []
+        basic_vm = [vb[0] for vb in virtual_backend_list if (vb[1], vb[2]) == (1, 1)]
+        if allow_intra_sched and len(basic_vm) and 0 < qc.num_qubits <= SUB_VM_MAX_SIZE:
+            self.sub_shapes = [shape for shape in sub_vm_shapes(basic_vm[0].coupling_map.get_edges()) if shape.num_qubits == qc.num_qubits]
+        # whether the program can share a qvm with others, i.e. it has a sub_qc
+        self.intra_eligible = len(self.sub_shapes) > 0
+
+        # backends[v] is the target of version v, followed by the sub-region shapes
+        self.backends = [vb[0] for vb in virtual_backend_list]
+        self.backends += [sub_vm(self.basis_gates, shape.num_qubits, shape.coupling_map) for shape in self.sub_shapes]
+        self.compiled = [None]*len(self.backends) # (compiled circuit, metrics)
+        self.gate_count_cache = {} # version -> gate counts of the compiled circuit
+        self.estimate = None
+        if lazy:
+            source_metrics = get_metrics(qc)
+            self.estimate = circuit_metrics(source_metrics.depth*ESTIMATE_SCALE, source_metrics.size*ESTIMATE_SCALE, source_metrics.ops, None)
+        self.speculation = None
+        self.init_views()
+
+        if not lazy:
+            self.compile_all()
+        elif speculative:
+            self.speculation = get_speculative_executor().submit(self.compile_all)
+
+    def init_views(self):
+        self.lock = threading.Lock()
+        self.qc = lazy_list(lambda v: self.compile_version(v)[0], self.versions)
+        # metrics of each compiled version, schedulers should read these instead of the circuits
+        self.metrics = lazy_list(self.version_metrics, self.versions)
+        # the program compiled to sub_shapes[k] and its metrics
+        self.sub_qc = lazy_list(lambda k: self.compile_version(self.versions + k)[0], len(self.sub_shapes))
+        self.sub_metrics = lazy_list(lambda k: self.version_metrics(self.versions + k), len(self.sub_shapes))
+
+    # compile version v (v >= self.versions is the sub-region shape v - self.versions) if it has not been compiled
+    def compile_version(self, v) -> ('QuantumCircuit', circuit_metrics):
+        with self.lock:
+            if self.compiled[v] == None:
+                compiled = self.cache.transpile(self.source_qc, self.backends[v]) if self.cache != None else transpile(self.source_qc, self.backends[v])
+                self.compiled[v] = (compiled, get_metrics(compiled, self.backends[v].target))
+            return self.compiled[v]
+
+    def compile_all(self):
+        for v in range(len(self.backends)):
+            self.compile_version(v)
+
+    # metrics of version v, an estimate if it has not been compiled yet. Never compiles.
+    def version_metrics(self, v) -> circuit_metrics:
+        compiled = self.compiled[v]
+        return compiled[1] if compiled != None else self.estimate
+
+    # gate counts of version v (see gate_counts). Until the version is compiled, the gates of the source circuit
+    # scaled by ESTIMATE_SCALE are spread evenly over the qubits and links of the virtual backend. Never compiles.
+    def version_gate_counts(self, v) -> np.ndarray:
+        compiled = self.compiled[v]
+        if compiled != None:
+            if v not in self.gate_count_cache:
+                self.gate_count_cache[v] = gate_counts(compiled[0])
+            return self.gate_count_cache[v]
+
+        num_qubits = self.backends[v].num_qubits
+        source = gate_counts(self.source_qc)
+        source_qubits = self.source_qc.num_qubits
+        one_qubit = source[:source_qubits].sum()*ESTIMATE_SCALE
+        measure = source[source_qubits:2*source_qubits].sum()
+        two_qubit = source[2*source_qubits:].sum()*ESTIMATE_SCALE
+        links = np.zeros((num_qubits, num_qubits))
+        for q1, q2 in self.backends[v].coupling_map.get_edges():
+            links[min(q1, q2), max(q1, q2)] = 1
+        return np.concatenate([np.full(num_qubits, one_qubit/num_qubits), np.full(num_qubits, measure/num_qubits),
+                               (links*two_qubit/max(links.sum(), 1)).ravel()])
+
+    # number of two-qubit gates of version v, from version_gate_counts
+    def two_qubit_gates(self, v) -> float:
+        num_qubits = self.backends[v].num_qubits
+        return float(self.version_gate_counts(v)[2*num_qubits:].sum())
+
+    def is_compiled(self) -> bool:
+        return all(compiled != None for compiled in self.compiled)
+
+    # locks, futures and the lazy views are rebuilt after unpickling (e.g. when returned from a worker process).
+    # The cache is not pickled either, the receiver sets it again if it has one (see build_executables)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('lock', 'qc', 'metrics', 'sub_qc', 'sub_metrics'):
+            del state[key]
+        state['speculation'] = None
+        state['cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_views()